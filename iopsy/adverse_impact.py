@@ -1,3 +1,8 @@
+from functools import lru_cache
+import numpy as np
+from pandas import DataFrame, Index, Series, factorize, isna
+from scipy.special import gammaln
+from scipy.stats import fisher_exact, random_table
 from .analysis import Analysis
 
 class AdverseImpact(Analysis):
@@ -40,14 +45,22 @@ class AdverseImpact(Analysis):
                          filters = filters)
         self.cutscore = cutscore
         self.groups = groups
-        self.score = cut(data[y], score = cutscore, groups = groups)
-        self.selection_rates = selection_rates(self.score, data[x])
+        self.score = cut(self.data[y], score = cutscore, groups = groups)
+        codes, uniques = self.factorize(x)
+        score = self.score
+        if score.hasnans:
+            # missing scores are left out of their group, as _clean_score does for the public wrappers
+            codes = np.where(score.isna().to_numpy(), -1, codes)
+            score = score.fillna(0)
+        self._score_u8 = score.to_numpy(dtype = np.uint8, copy = False)
+        tab = _pass_fail_table(self._score_u8, codes, len(uniques))
+        self.selection_rates = _selection_rates(tab, uniques, name = x)
         if referent is not None:
             self.referent = referent
         else:
             self.referent = determine_referent(self.selection_rates, min_ref = min_ref)
         self.effect = impact_ratios(self.selection_rates, referent = self.referent)
-        self.p = fet_series(data[x], self.score, self.referent)
+        self.p = _fet_series(tab, uniques, self.referent)
         
     def summary(self):
         """Summary of Results
@@ -56,8 +69,11 @@ class AdverseImpact(Analysis):
         4 columns indicating the selection rate (sr), sample size (n), impact ratio (ir), and p-value
         from a fishers exact test (fet_p)
         """
-        from pandas import concat
-        return(concat([self.selection_rates, self.effect, self.p], axis = 1))
+        idx = self.selection_rates.index
+        return(DataFrame({'sr': self.selection_rates['sr'].to_numpy(),
+                          'n': self.selection_rates['n'].to_numpy(),
+                          'ir': self.effect.reindex(idx).to_numpy(),
+                          'fet_p': self.p.reindex(idx).to_numpy()}, index = idx))
     
     def graph(self, **kwargs):
         """Graph Results
@@ -75,6 +91,23 @@ class AdverseImpact(Analysis):
         for idx, val in enumerate(sr['sr']):
             ax.text(idx - .1, val-.02, str(round(val, 2))[1:], color = 'white', fontweight = 'bold')
         
+@lru_cache(maxsize = 64)
+def _lookup_table(groups):
+    """Boolean lookup table over small non-negative integer codes, or None if the groups aren't such codes.
+    
+    groups is a tuple of (type, value) pairs, so that groups which compare equal across types (1, 1.0,
+    True) do not share a cache entry. Bools are entered as 0/1, as Series.isin matches them.
+    """
+    groups = [g for _, g in groups]
+    if not all(isinstance(g, (int, np.integer, np.bool_)) for g in groups):
+        return None
+    codes = [int(g) for g in groups]
+    if min(codes) < 0 or max(codes) >= 2**16:
+        return None
+    tbl = np.zeros(max(codes) + 2, dtype = np.bool_)
+    tbl[codes] = True
+    return tbl
+
 def cut(y, score = None, groups = None):
     """Implement a Cutscore
     
@@ -97,16 +130,57 @@ def cut(y, score = None, groups = None):
         
     Returns
     -------
-    pandas.Series of Booleans with True denoting passing, and False denoting failing
+    pandas.Series of uint8 with 1 denoting passing, and 0 denoting failing. A cutscore on a nullable
+    column gives a UInt8 Series instead, with missing scores left as <NA>.
     """
     if score is not None:
-        return(y >= score)
+        if not isinstance(y.dtype, np.dtype):
+            # nullable columns keep their missing scores as <NA> rather than counting them as fails
+            return((y >= score).astype('UInt8'))
+        passed = np.greater_equal(y.to_numpy(), score)
     elif groups is not None:
         if isinstance(groups, str):
             groups = [groups]
-        return(y.isin(groups))
+        # plain numpy integer codes use the lookup table; object, string, categorical and nullable
+        # columns go through Series.isin, which handles their missing values and is faster on them
+        tbl = None
+        if isinstance(y.dtype, np.dtype) and y.dtype.kind in 'biu':
+            tbl = _lookup_table(tuple((type(g), g) for g in groups))
+        if tbl is None:
+            passed = y.isin(groups).to_numpy(dtype = np.bool_, na_value = False)
+        else:
+            # anything outside the table lands on its trailing False slot
+            arr, hi = y.to_numpy(), tbl.shape[0] - 1
+            passed = tbl[np.where((arr >= 0) & (arr < hi), arr, hi)]
+    else:
+        return None
+    return(Series(passed.view(np.uint8), index = y.index, name = y.name))
     
-def selection_rates(score, by):
+def _pass_fail_table(score, codes, n_groups):
+    """Group x (fail, pass) count table in one bincount, skipping missing groups (code -1).
+    
+    score must be a 0/1 uint8, boolean, or integer ndarray without missing values; it is promoted inside
+    the add rather than cast up front. The public wrappers pass arbitrary scores through _clean_score.
+    """
+    valid = codes >= 0
+    if not valid.all():
+        codes, score = codes[valid], score[valid]
+    flat = codes*2
+    flat += score
+    return np.bincount(flat, minlength = 2*n_groups).reshape(-1, 2)
+
+def _clean_score(score, codes):
+    """Drop rows with a missing score (by recoding their group to -1) and cast score to integers."""
+    score = np.asarray(score)
+    if score.dtype.kind in 'bu':
+        return score, codes
+    missing = isna(score)
+    if missing.any():
+        codes = np.where(missing, -1, codes)
+        score = np.where(missing, 0, score)
+    return score.astype(np.int64), codes
+
+def selection_rates(score, by, factors = None):
     """Calculate Selection Rates
     
     Calculate the selection rates and sample size for each group specified in the by variable.
@@ -119,16 +193,20 @@ def selection_rates(score, by):
     by : pandas.Series of string
         The categorical variable by which to group the individuals. This is most typically gender
         or ethnicity.
+    factors : tuple of (codes, uniques) or None
+        The output of pandas.factorize on by. If supplied, by is not factorized again.
         
     Returns
     -------
     pandas.DataFrame with groups as index and selection rates (sr) and sample size (n) as columns
     """
-    from pandas import concat
-    df = concat([score, by], axis = 1)
-    res = df.groupby(by).agg(['mean', 'count'])
-    res.columns = ['sr', 'n']
-    return res
+    codes, uniques = factorize(by.values, sort = True) if factors is None else factors
+    score, codes = _clean_score(score, codes)
+    return _selection_rates(_pass_fail_table(score, codes, len(uniques)), uniques, name = by.name)
+
+def _selection_rates(tab, uniques, name = None):
+    n = tab.sum(axis = 1)
+    return DataFrame({'sr': tab[:, 1]/n, 'n': n}, index = Index(uniques, name = name))
 
 def determine_referent(sr, min_ref = 5):
     """Determine the Referent
@@ -150,8 +228,11 @@ def determine_referent(sr, min_ref = 5):
     -------
     String name of the referent group
     """
-    sr = sr[sr['n'] >= min_ref].copy()
-    return(sr.sort_values(['sr','n'], ascending = False).index[0])
+    srv = sr['sr'].to_numpy()
+    nv = sr['n'].to_numpy()
+    idx = np.where(nv >= min_ref)[0]
+    best = idx[np.lexsort((-nv[idx], -srv[idx]))[0]]
+    return(sr.index[best])
 
 def impact_ratios(sr, referent):
     """Calculate Impact Ratios
@@ -168,15 +249,14 @@ def impact_ratios(sr, referent):
     referent : string
         Name of the group that is serving as the referent.
     """
-    ir = sr['sr']/sr.loc[referent,'sr']
-    ir.name = 'ir'
-    return ir
+    return Series(sr['sr'].to_numpy()/sr.at[referent, 'sr'], index = sr.index, name = 'ir')
 
-def contingency_generator(by, score, referent):
+def contingency_generator(by, score, referent, factors = None):
     """Contingency Table Generator
     
     This is a generator that yields a 2x2 contingency table on every iteration. This will provide a
-    table for every other groups comparison with the referent group.
+    table for every other groups comparison with the referent group. Each table is a numpy array with
+    the focal group in the first row and the referent in the second, and fails then passes as columns.
     
     Parameters
     ----------
@@ -187,13 +267,19 @@ def contingency_generator(by, score, referent):
         A series of booleans indicating whether the individual passed (True) or failed (False).
     referent : string
         Name of the group that is serving as the referent.
+    factors : tuple of (codes, uniques) or None
+        The output of pandas.factorize on by. If supplied, by is not factorized again.
     """
-    from pandas import crosstab
-    tab = crosstab(by, score)
-    for focal in tab.index.drop(referent):
-        yield(focal, tab.loc[[focal, referent]])
+    codes, uniques = factorize(by.values, sort = True) if factors is None else factors
+    score, codes = _clean_score(score, codes)
+    tab = _pass_fail_table(score, codes, len(uniques))
+    ref_idx = np.where(uniques == referent)[0][0]
+    for i, focal in enumerate(uniques):
+        if i == ref_idx:
+            continue
+        yield(focal, tab[[i, ref_idx]])
 
-def fet_series(by, score, referent):
+def fet_series(by, score, referent, factors = None):
     """Fisher Exact Test Series
     
     Perform a series of Fisher Exact Tests of each group relative to the referent group. 
@@ -207,15 +293,109 @@ def fet_series(by, score, referent):
         A series of booleans indicating whether the individual passed (True) or failed (False)
     referent : string
         Name of the group that is serving as the referent.
+    factors : tuple of (codes, uniques) or None
+        The output of pandas.factorize on by. If supplied, by is not factorized again.
         
     Returns
     -------
     pandas.Series of p values from the fisher exact tests.
     """
-    from scipy.stats import fisher_exact
-    from pandas import Series
-    idx, pval = [], []
-    for focal, tab in contingency_generator(by, score, referent):
-        idx.append(focal)
-        pval.append(fisher_exact(tab)[1])
-    return(Series(pval, index = idx, name = 'fet_p'))
+    codes, uniques = factorize(by.values, sort = True) if factors is None else factors
+    score, codes = _clean_score(score, codes)
+    return _fet_series(_pass_fail_table(score, codes, len(uniques)), uniques, referent)
+
+def _fet_series(tab, uniques, referent):
+    ref_idx = np.where(uniques == referent)[0][0]
+    focal = np.arange(len(uniques)) != ref_idx
+    pval = fisher_exact_batch(tab[focal, 1], tab[focal, 0], tab[ref_idx, 1], tab[ref_idx, 0])
+    return(Series(pval, index = uniques[focal], name = 'fet_p'))
+
+_MAX_BATCH_SUPPORT = 10000
+
+def fisher_exact_batch(a, b, c, d):
+    """Batched Fisher Exact Tests
+    
+    Two-sided Fisher exact test p values for a batch of 2x2 tables of the form [[a, b], [c, d]]. This
+    matches scipy.stats.fisher_exact, but evaluates the hypergeometric distribution for every table at
+    once rather than one table at a time.
+    
+    Parameters
+    ----------
+    a, b, c, d : array-like of int
+        The cell counts of each table. Scalars are broadcast against arrays, so a shared referent row
+        can be passed as scalars.
+        
+    Returns
+    -------
+    numpy.ndarray of p values
+    """
+    a, b, c, d = np.broadcast_arrays(*[np.atleast_1d(np.asarray(val, dtype = np.int64))
+                                       for val in (a, b, c, d)])
+    if a.size == 0:
+        return np.empty(a.shape, dtype = np.float64)
+    M = a + b + c + d
+    n1 = a + b
+    n = a + c
+    lo = np.maximum(0, n - (M - n1))
+    hi = np.minimum(n, n1)
+    # the grid below is padded to the widest support in the batch, so tables with a very wide support
+    # are handed to scipy one at a time rather than inflating the grid for every table
+    wide = hi - lo >= _MAX_BATCH_SUPPORT
+    if wide.any():
+        pval = np.empty(a.shape, dtype = np.float64)
+        pval[wide] = [fisher_exact([[ai, bi], [ci, di]])[1]
+                      for ai, bi, ci, di in zip(a[wide], b[wide], c[wide], d[wide])]
+        narrow = ~wide
+        if narrow.any():
+            pval[narrow] = fisher_exact_batch(a[narrow], b[narrow], c[narrow], d[narrow])
+        return pval
+    # log factorial lookup table shared by every table in the batch
+    LG = gammaln(np.arange(M.max() + 1) + 1)
+    const = LG[n1] + LG[M - n1] + LG[n] + LG[M - n] - LG[M]
+    
+    def pmf(x, i = slice(None)):
+        return np.exp(const[i] - LG[x] - LG[n1[i] - x] - LG[n[i] - x] - LG[M[i] - n1[i] - n[i] + x])
+    
+    # tables with an empty row or column carry no information, scipy reports a p of 1
+    degenerate = (n1 == 0) | (c + d == 0) | (n == 0) | (b + d == 0)
+    x = np.minimum(lo[:, None] + np.arange((hi - lo).max() + 1), hi[:, None])
+    grid = pmf(x, (slice(None), None))
+    grid[lo[:, None] + np.arange(x.shape[1]) > hi[:, None]] = 0
+    pexact = pmf(a)
+    pmode = pmf((n + 1)*(n1 + 1)//(M + 2))
+    # relative tolerance so that tables tied with the observed one are not lost to rounding in the
+    # log factorial sums
+    epsilon = 1e-7
+    pval = np.where(grid <= pexact[:, None]*(1 + epsilon), grid, 0).sum(axis = 1)
+    at_mode = np.abs(pexact - pmode)/np.maximum(pexact, pmode) <= epsilon
+    pval[degenerate | at_mode] = 1
+    return np.minimum(pval, 1)
+
+def fisher_exact_mc(table, n_resamples = 9999, random_state = None):
+    """Monte Carlo Fisher Exact Test
+    
+    Fisher's exact test for an R x C contingency table, such as a multi-level outcome crossed with a
+    demographic variable, where full enumeration of the tables is intractable. Random tables sharing
+    the observed marginals are drawn with Patefield's algorithm and compared to the observed table on
+    the -sum(log(n_ij!)) statistic.
+    
+    Parameters
+    ----------
+    table : 2d array-like of int
+        The R x C contingency table.
+    n_resamples : int
+        The number of random tables to draw.
+    random_state : None, int, or numpy.random.Generator
+        Seed or generator for reproducible draws.
+        
+    Returns
+    -------
+    float p value
+    """
+    table = np.asarray(table, dtype = np.int64)
+    sims = random_table(table.sum(axis = 1), table.sum(axis = 0), seed = random_state).rvs(n_resamples)
+    obs = -gammaln(table + 1).sum()
+    stats = -gammaln(sims + 1).sum(axis = (1, 2))
+    # small tolerance so tables tied with the observed one are not lost to rounding
+    count = (stats <= obs + 1e-7*abs(obs)).sum()
+    return (1 + count)/(n_resamples + 1)
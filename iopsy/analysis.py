@@ -1,3 +1,8 @@
+import numpy as np
+from pandas import Series, factorize
+from scipy.stats import median_abs_deviation
+from ._compat import HAS_NUMBA, njit, prange
+
 class Analysis:
     def __init__(self, data, analysis, x, y = None, filters = None):
         """Analysis
@@ -13,14 +18,41 @@ class Analysis:
         self.x = x
         self.y = y
         self.filters = filters
-        for col, filts in filters.items():
+        for col, filts in (filters or {}).items():
             if not isinstance(filts, list):
                 filts = [filts]
             for filt in filts:
                 self.data = drop_outlier(self.data, col, **filt)
         self.p = None
         self.effect = None
+        self._factor_cache = {}
+        
+    def factorize(self, col):
+        """Factorize a Column
         
+        Integer encode a column of the data, returning the (codes, uniques) from pandas.factorize.
+        The result is memoized so every group-wise calculation on the column shares a single pass.
+        
+        Parameters
+        ----------
+        col : str column name
+        """
+        if col not in self._factor_cache:
+            self._factor_cache[col] = factorize(self.data[col].values, sort = True)
+        return self._factor_cache[col]
+        
+def _category_counts(x, normalize = False):
+    codes, uniques = factorize(x.values)
+    valid = codes >= 0
+    counts = np.bincount(codes[valid], minlength = len(uniques))
+    if normalize:
+        counts = counts/counts.sum()
+    res = counts[codes]
+    if not valid.all():
+        res = res.astype(np.float64)
+        res[~valid] = np.nan
+    return(Series(res, index = x.index, name = x.name))
+
 def cat_count(x):
     """Category Count
     
@@ -32,8 +64,7 @@ def cat_count(x):
     ----------
     x : pandas.Series
     """
-    vc = x.value_counts()
-    return(x.replace(vc.index,vc))
+    return(_category_counts(x))
 
 def cat_prop(x):
     """Category Proportion
@@ -46,8 +77,21 @@ def cat_prop(x):
     ----------
     x : pandas.Series
     """
-    props = x.value_counts(normalize = True)
-    return(x.replace(props.index, props))
+    return(_category_counts(x, normalize = True))
+
+# error_model = 'numpy' lets a zero scale give inf/nan, as the pandas paths do, rather than raise
+@njit(cache = True, parallel = True, error_model = 'numpy')
+def _hampel(arr):
+    # NaN is skipped when estimating the center and scale and propagated to the output
+    vals = arr[~np.isnan(arr)]
+    if vals.shape[0] == 0:
+        return np.full_like(arr, np.nan)
+    med = np.median(vals)
+    mad = np.median(np.abs(vals - med))/0.6744897501960817
+    out = np.empty_like(arr)
+    for i in prange(arr.shape[0]):
+        out[i] = (arr[i] - med)/mad
+    return out
 
 def hampel_identifier(x):
     """Hampel Identifier
@@ -61,8 +105,31 @@ def hampel_identifier(x):
     ----------
     x : pandas.Series
     """
-    from scipy.stats import median_abs_deviation
-    return((x-x.median())/median_abs_deviation(x, scale = 'normal'))
+    if HAS_NUMBA:
+        arr = np.ascontiguousarray(x.to_numpy(dtype = np.float64))
+        return(Series(_hampel(arr), index = x.index, name = x.name))
+    return((x-x.median())/median_abs_deviation(x, scale = 'normal', nan_policy = 'omit'))
+
+@njit(cache = True, parallel = True, error_model = 'numpy')
+def _zscore(arr):
+    total, n = 0.0, 0
+    for i in prange(arr.shape[0]):
+        if not np.isnan(arr[i]):
+            total += arr[i]
+            n += 1
+    # the sample standard deviation is undefined below two observations, as with Series.std
+    if n < 2:
+        return np.full_like(arr, np.nan)
+    mu = total/n
+    ss = 0.0
+    for i in prange(arr.shape[0]):
+        if not np.isnan(arr[i]):
+            ss += (arr[i] - mu)**2
+    sigma = np.sqrt(ss/(n - 1))
+    out = np.empty_like(arr)
+    for i in prange(arr.shape[0]):
+        out[i] = (arr[i] - mu)/sigma
+    return out
 
 def standard_score(x):
     """Standard Score
@@ -74,8 +141,31 @@ def standard_score(x):
     ----------
     x : pandas.Series
     """
+    if HAS_NUMBA:
+        arr = np.ascontiguousarray(x.to_numpy(dtype = np.float64))
+        return(Series(_zscore(arr), index = x.index, name = x.name))
     return((x-x.mean())/x.std())
 
+@njit(cache = True)
+def _sorted_quantile(vals, q):
+    pos = q*(vals.shape[0] - 1)
+    lo = int(np.floor(pos))
+    hi = min(lo + 1, vals.shape[0] - 1)
+    return vals[lo] + (pos - lo)*(vals[hi] - vals[lo])
+
+@njit(cache = True, parallel = True, error_model = 'numpy')
+def _iqr_score(arr, q):
+    # one sort serves the median and both quantiles
+    vals = np.sort(arr[~np.isnan(arr)])
+    if vals.shape[0] == 0:
+        return np.full_like(arr, np.nan)
+    med = _sorted_quantile(vals, .5)
+    scale = _sorted_quantile(vals, 1 - q) - _sorted_quantile(vals, q)
+    out = np.empty_like(arr)
+    for i in prange(arr.shape[0]):
+        out[i] = (arr[i] - med)/scale
+    return out
+
 def iqr_score(x, q = .25):
     """Inner Quantile Range Score
     
@@ -89,8 +179,29 @@ def iqr_score(x, q = .25):
     q : float between 0 and 1
         The quantile value for determining the IQR. A q of .25 yields a quartile
     """
-    scale = x.quantile(1-q)-x.quantile(q)
-    return(x-x.median()/scale)
+    arr = np.ascontiguousarray(x.to_numpy(dtype = np.float64))
+    if HAS_NUMBA:
+        return(Series(_iqr_score(arr, q), index = x.index, name = x.name))
+    med = np.nanmedian(arr)
+    lo, hi = np.nanquantile(arr, [q, 1 - q])
+    return(Series((arr - med)/(hi - lo), index = x.index, name = x.name))
+
+@njit(cache = True, parallel = True, error_model = 'numpy')
+def _outlier_mask_z(arr, mu, sigma, thresh, less):
+    mask = np.empty(arr.shape[0], dtype = np.bool_)
+    for i in prange(arr.shape[0]):
+        z = abs((arr[i] - mu)/sigma)
+        if less:
+            mask[i] = z > thresh
+        else:
+            mask[i] = z < thresh
+    return mask
+
+def _standard_score_mask(arr, val, less):
+    return _outlier_mask_z(arr, np.nanmean(arr), np.nanstd(arr, ddof = 1), val, less)
+
+# fused score -> abs -> threshold kernels for the built in methods
+_FUSED_MASKS = {standard_score: _standard_score_mask}
 
 def drop_outlier(data, x, method = standard_score, val = 2, less = False, **kwargs):
     """Drop Outliers
@@ -113,6 +224,9 @@ def drop_outlier(data, x, method = standard_score, val = 2, less = False, **kwar
     less : bool
         Should the value to drop be below the critical value?
     """
+    if HAS_NUMBA and not kwargs and method in _FUSED_MASKS:
+        arr = np.ascontiguousarray(data[x].to_numpy(dtype = np.float64))
+        return(data.iloc[_FUSED_MASKS[method](arr, val, less)])
     if less:
         bool_mask = method(data[x], **kwargs).abs() > val
     else:
@@ -1,3 +1,34 @@
+import warnings
+import numpy as np
+from pandas import DataFrame, Series
+from pandas.api.types import is_numeric_dtype
+from scipy.linalg import eigh
+from scipy.optimize import minimize
+from .._compat import HAS_NUMBA, njit, prange
+
+def _as_matrix(data):
+    """Item responses as an ndarray for the numpy reductions.
+    
+    Booleans and integer codes that fit in int8 (e.g. Likert responses, whatever integer dtype they
+    arrive in) are held as float32, which represents them exactly in half the bytes; every reduction
+    over them accumulates in float64. Anything else is float64.
+    
+    Validated once here so every downstream reduction can stay on the plain numpy path: non-numeric
+    columns and missing or infinite responses raise a ValueError.
+    """
+    if not all(is_numeric_dtype(dtype) for dtype in data.dtypes):
+        raise ValueError('item responses must be numeric')
+    X = data.to_numpy()
+    if X.dtype.kind not in 'biuf':
+        # mixed bool/numeric or nullable columns come back as object
+        X = data.to_numpy(dtype = np.float64, na_value = np.nan)
+    if X.dtype.kind == 'b' or (X.dtype.kind in 'iu' and X.size and -128 <= X.min() and X.max() <= 127):
+        return X.astype(np.float32)
+    X = X.astype(np.float64, copy = False)
+    if not np.isfinite(X).all():
+        raise ValueError('item responses must be finite, drop or impute missing responses first')
+    return X
+
 def cronbachs_alpha(data):
     """Cronbach's Alpha
     
@@ -8,11 +39,91 @@ def cronbachs_alpha(data):
     data : pandas.DataFrame
         df containing the item responses for the scale
     """
-    k = data.shape[1]
-    sum_item_var = data.var().sum()
-    scale_var = data.sum(axis = 1).var()
+    X = _as_matrix(data)
+    k = X.shape[1]
+    sum_item_var = X.var(axis = 0, ddof = 1, dtype = np.float64).sum()
+    scale_var = np.add.reduce(X, axis = 1, dtype = np.float64).var(ddof = 1)
     return (k/(k-1))*(1-(sum_item_var/scale_var))
 
+@njit(cache = True, parallel = True, fastmath = True)
+def _item_total_kernel(X, S):
+    n, k = X.shape
+    S_mean = S.mean()
+    mu = np.empty(k)
+    v = np.empty(k)
+    cov_iS = np.empty(k)
+    for j in prange(k):
+        total = 0.0
+        for i in range(n):
+            total += X[i, j]
+        x_mean = total/n
+        mu[j] = x_mean
+        ss, sp = 0.0, 0.0
+        for i in range(n):
+            d = X[i, j] - x_mean
+            ss += d*d
+            sp += d*(S[i] - S_mean)
+        v[j] = ss/(n - 1)
+        cov_iS[j] = sp/(n - 1)
+    return mu, v, cov_iS
+
+def _item_total_moments(X):
+    """Item means and variances, total score mean and variance, and item-total covariances.
+    
+    Everything the leave-one-out item statistics need, from a single pass over data. Returned as
+    (mu, v, S_mean, T, cov_iS).
+    """
+    n = X.shape[0]
+    S = np.add.reduce(X, axis = 1, dtype = np.float64)
+    if HAS_NUMBA:
+        mu, v, cov_iS = _item_total_kernel(np.asfortranarray(X), S)
+    else:
+        mu = X.mean(axis = 0, dtype = np.float64)
+        centered = X - mu
+        v = centered.var(axis = 0, ddof = 1)
+        cov_iS = centered.T @ (S - S.mean())/(n - 1)
+    return mu, v, S.mean(), S.var(ddof = 1), cov_iS
+
+def _covariance_moments(X):
+    """The same moments as _item_total_moments, plus the item covariance matrix C, from one syrk.
+    
+    Every total score statistic is a reduction of C: var(S) = C.sum(), cov(x_i, S) = C.sum(axis = 1).
+    Returned as (mu, v, S_mean, T, cov_iS, C).
+    """
+    n, k = X.shape
+    if X.dtype == np.float32:
+        # int8 range codes (see _as_matrix): a float32 cross product over at most 1024 rows sums to no
+        # more than 1024*128**2 = 2**24, so each tile is exact and only the running total needs float64.
+        # Tiles are also capped at ~256KB so they stay in L2.
+        rows = max(1, min(1024, 65536//k))
+        XtX = np.zeros((k, k))
+        for start in range(0, n, rows):
+            tile = X[start:start + rows]
+            XtX += tile.T @ tile
+        colsum = np.add.reduce(X, axis = 0, dtype = np.float64)
+        mu = colsum/n
+        C = (XtX - np.outer(colsum, mu))/(n - 1)
+    else:
+        mu = X.mean(axis = 0, dtype = np.float64)
+        Xc = X - mu
+        C = Xc.T @ Xc/(n - 1)
+    return mu, np.diag(C).copy(), mu.sum(), C.sum(), C.sum(axis = 1), C
+
+def _citr_impl(v, T, cov_iS):
+    # cov(x_i, S - x_i) = cov(x_i, S) - var(x_i), var(S - x_i) = var(S) - 2cov(x_i, S) + var(x_i)
+    return (cov_iS - v)/np.sqrt(v*(T - 2*cov_iS + v))
+
+def _alpha_if_deleted_impl(v, T, cov_iS):
+    k = len(v)
+    return ((k - 1)/(k - 2))*(1 - (v.sum() - v)/(T - 2*cov_iS + v))
+
+def _mean_if_deleted_impl(mu, S_mean):
+    # the scale mean without item i is (S - x_i)/(k - 1)
+    return (S_mean - mu)/(len(mu) - 1)
+
+def _sd_if_deleted_impl(v, T, cov_iS):
+    return np.sqrt(T - 2*cov_iS + v)/(len(v) - 1)
+
 def citr(data):
     """Corrected Item-Total Correlations
     
@@ -25,28 +136,8 @@ def citr(data):
     data : pandas.DataFrame
         df containing the item responses for the scale
     """
-    from numpy import corrcoef
-    from pandas import Series
-    res = []
-    for col, df in iterdrop(data):
-        x = df.sum(axis = 1)
-        y = data[col]
-        res.append(np.corrcoef(x, y)[0,1])
-    return Series(res, index = data.columns)
-        
-def iterdrop(data):
-    """Iteratively Drop Columns From Data
-    
-    This is a generator that yields the name of the column dropped as well as the DataFrame missing the
-    named column.
-    
-    Parameters
-    ----------
-    data : pandas.DataFrame
-        df with columns to iteratively drop through
-    """
-    for col in data.columns:
-        yield(col, data.drop(col, axis = 1))
+    mu, v, S_mean, T, cov_iS = _item_total_moments(_as_matrix(data))
+    return Series(_citr_impl(v, T, cov_iS), index = data.columns)
         
 def alpha_if_deleted(data):
     """Cronbach's Alpha if Item Deleted
@@ -59,29 +150,53 @@ def alpha_if_deleted(data):
     data : pandas.DataFrame
         df containing the item responses for the scale
     """
-    from pandas import Series
-    res = []
-    for col, df in iterdrop(data):
-        res.append(cronbachs_alpha(df))
-    return Series(res, index = data.columns)
+    mu, v, S_mean, T, cov_iS = _item_total_moments(_as_matrix(data))
+    return Series(_alpha_if_deleted_impl(v, T, cov_iS), index = data.columns)
+
+def _uls_objective(psi, R):
+    # squared residual of the one-factor model with uniquenesses psi, and its gradient; the loadings are
+    # the leading eigenpair of the reduced correlation matrix, its eigenvalue floored as in FactorAnalyzer
+    A = R.copy()
+    np.fill_diagonal(A, 1 - psi)
+    w, vec = eigh(A, subset_by_index = [A.shape[0] - 1, A.shape[0] - 1])
+    lam, v = w[0], vec[:, 0]
+    lam_c = max(lam, np.finfo(float).eps*100)
+    err = (A**2).sum() - 2*lam*lam_c + lam_c**2
+    return err, 2*lam_c*v**2 - 2*(1 - psi)
+
+def _loadings_impl(R):
+    # minres (ULS) fit over the uniquenesses as FactorAnalyzer does it: L-BFGS-B from 1 - SMC, with the
+    # uniquenesses bounded to [.005, 1]
+    k = R.shape[0]
+    try:
+        inv = np.linalg.inv(R)
+    except np.linalg.LinAlgError:
+        inv = np.linalg.pinv(R)
+    res = minimize(_uls_objective, 1/np.diag(inv), args = (R,), jac = True, method = 'L-BFGS-B',
+                   bounds = [(.005, 1)]*k, options = {'maxiter': 1000})
+    if not res.success:
+        warnings.warn(f'item_loadings failed to converge: {res.message}', RuntimeWarning)
+    reduced = R.copy()
+    np.fill_diagonal(reduced, 1 - res.x)
+    w, vec = eigh(reduced, subset_by_index = [k - 1, k - 1])
+    load = vec[:, 0]*np.sqrt(max(w[0], 0))
+    return load if load.sum() >= 0 else -load
 
 def item_loadings(data):
     """Items' Loadings on to a Single Factor
     
-    Calculate all of the item loadings on to a single factor. This relies heavily on FactorAnalyzer. Its
-    really just a wrapper to handle the little things.
+    Calculate all of the item loadings on to a single factor. These are the minimum residual (minres)
+    loadings, the same solution FactorAnalyzer(n_factors = 1, rotation = None) arrives at, found here
+    by minimizing the residual over the uniquenesses with an analytic gradient. Loadings are signed so
+    that they sum to a positive value.
     
     Parameters
     ----------
     data : pandas.DataFrame
         df containing the item responses for the scale
     """
-    from factor_analyzer.factor_analyzer import FactorAnalyzer
-    from pandas import Series
-    fa = FactorAnalyzer(n_factors=1, rotation = None)
-    fa.fit(data)
-    ldng = [val[0] for val in fa.loadings_]
-    return Series(ldng, index = data.columns)
+    X = _as_matrix(data)
+    return Series(_loadings_impl(np.corrcoef(X, rowvar = False)), index = data.columns)
 
 def mean_if_deleted(data):
     """Mean Scale Mean if Item is Deleted
@@ -93,11 +208,8 @@ def mean_if_deleted(data):
     data : pandas.DataFrame
         df containing the item responses for the scale
     """
-    from pandas import Series
-    res = []
-    for col, df in iterdrop(data):
-        res.append(df.mean(axis = 1).mean())
-    return Series(res, index = data.columns)
+    mu, v, S_mean, T, cov_iS = _item_total_moments(_as_matrix(data))
+    return Series(_mean_if_deleted_impl(mu, S_mean), index = data.columns)
 
 def sd_if_deleted(data):
     """Standard Deviation of Scale Mean if Item is Deleted
@@ -109,11 +221,8 @@ def sd_if_deleted(data):
     data : pandas.DataFrame
         df containing the item responses for the scale
     """
-    from pandas import Series
-    res = []
-    for col, df in iterdrop(data):
-        res.append(df.mean(axis = 1).std())
-    return Series(res, index = data.columns)
+    mu, v, S_mean, T, cov_iS = _item_total_moments(_as_matrix(data))
+    return Series(_sd_if_deleted_impl(v, T, cov_iS), index = data.columns)
 
 def ctt_item_stats(data):
     """Calculate the Typical Classical Test Theory Item Statistics
@@ -127,17 +236,18 @@ def ctt_item_stats(data):
     data : pd.DataFrame
         df containing the item responses for the scale
     """
-    from pandas import DataFrame
+    mu, v, S_mean, T, cov_iS, C = _covariance_moments(_as_matrix(data))
+    sd = np.sqrt(v)
     analyses = {
-        'mean': data.mean(),
-        'sd': data.std(),
-        'mean_if_deleted': mean_if_deleted(data),
-        'sd_if_deleted': sd_if_deleted(data),
-        'citr': citr(data),
-        'loadings': item_loadings(data),
-        'alpha_if_deleted': alpha_if_deleted(data)
+        'mean': mu,
+        'sd': sd,
+        'mean_if_deleted': _mean_if_deleted_impl(mu, S_mean),
+        'sd_if_deleted': _sd_if_deleted_impl(v, T, cov_iS),
+        'citr': _citr_impl(v, T, cov_iS),
+        'loadings': _loadings_impl(C/np.outer(sd, sd)),
+        'alpha_if_deleted': _alpha_if_deleted_impl(v, T, cov_iS)
     }
-    return DataFrame(analyses)
+    return DataFrame(analyses, index = data.columns)
 
 def spearman_brown(old_rxx, new_rxx = None, n = None):
     """Spearman Brown Formula
@@ -178,5 +288,4 @@ def reliability_correction(rxy, rxx = 1, ryy = 1):
     ryy : float between 0 and 1
         the reliability of the y variable
     """
-    from numpy import sqrt
-    return(rxy/sqrt(rxx * ryy))
+    return(rxy/np.sqrt(rxx * ryy))
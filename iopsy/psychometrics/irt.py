@@ -1,5 +1,6 @@
-from numpy import exp
-from pandas import DataFrame
+import numpy as np
+from pandas import DataFrame, Series
+from scipy.special import expit
 
 def rasch_irf(theta, b):
     """Rasch Item Response Function
@@ -13,7 +14,7 @@ def rasch_irf(theta, b):
     b : numeric
         the item difficulty level
     """
-    return(exp(theta - b)/(1 + exp(theta - b)))
+    return(expit(np.subtract(theta, b)))
 
 def generate_random_rasch_items(theta, bs = None):
     """Generate Random Items
@@ -29,8 +30,8 @@ def generate_random_rasch_items(theta, bs = None):
     """
     if bs is None:
         bs = [x/2 for x in range(-6,7)]
-    probs = {}
-    for b in bs:
-        probs[f'item_{b}'] = rasch_irf(theta, b)
-    df = DataFrame(probs)
-    return df.applymap(lambda p: rd.choices([0,1], [1-p, p])[0])
\ No newline at end of file
+    probs = rasch_irf(np.asarray(theta, dtype = np.float64)[:, None],
+                      np.asarray(bs, dtype = np.float64)[None, :])
+    responses = np.random.default_rng().binomial(1, probs).astype(np.int8)
+    index = theta.index if isinstance(theta, Series) else None
+    return DataFrame(responses, index = index, columns = [f'item_{b}' for b in bs])
\ No newline at end of file
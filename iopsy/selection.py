@@ -1,7 +1,70 @@
+import warnings
 import numpy as np
+from scipy.optimize import minimize
+from ._compat import HAS_NUMBA, njit
+
+@njit(cache = True, fastmath = True)
+def _cd_lasso(X, resid, col_norm2, thresh, tol, max_iter):
+    n, k = X.shape
+    weights = np.zeros(k)
+    for _ in range(max_iter):
+        max_step = 0.0
+        for j in range(k):
+            if col_norm2[j] == 0:
+                continue
+            rho = col_norm2[j] * weights[j]
+            for i in range(n):
+                rho += X[i, j] * resid[i]
+            new = np.sign(rho) * max(abs(rho) - thresh[j], 0.0) / col_norm2[j]
+            step = new - weights[j]
+            if step != 0:
+                for i in range(n):
+                    resid[i] -= step * X[i, j]
+                weights[j] = new
+                max_step = max(max_step, abs(step))
+        if max_step < tol:
+            return weights, True
+    return weights, False
+
+def _cd_lasso_numpy(X, resid, col_norm2, thresh, tol, max_iter):
+    k = X.shape[1]
+    weights = np.zeros(k)
+    for _ in range(max_iter):
+        max_step = 0
+        for j in range(k):
+            if col_norm2[j] == 0:
+                continue
+            rho = X[:, j] @ resid + col_norm2[j] * weights[j]
+            new = np.sign(rho) * max(abs(rho) - thresh[j], 0) / col_norm2[j]
+            step = new - weights[j]
+            if step != 0:
+                resid -= step * X[:, j]
+                weights[j] = new
+                max_step = max(max_step, abs(step))
+        if max_step < tol:
+            return weights, True
+    return weights, False
+
+def _minimize_lasso(X, resid, thresh, tol, max_iter):
+    # weights = pos - neg with pos, neg >= 0 makes the penalty linear, so the cost is smooth and the
+    # gradient below is exact on the box L-BFGS-B searches
+    k = X.shape[1]
+    def cost_grad(z):
+        # one X @ w and one X.T @ r per evaluation, shared between the cost and its gradient
+        r = resid - X @ (z[:k] - z[k:])
+        xr = X.T @ r
+        cost = .5 * (r @ r) + thresh @ (z[:k] + z[k:])
+        return cost, np.concatenate([thresh - xr, thresh + xr])
+    # stop on the projected gradient; L-BFGS-B's relative reduction test (ftol) can fire on a stalled
+    # line search well short of the optimum, so it is held at machine precision
+    res = minimize(cost_grad, np.zeros(2 * k), jac = True, method = 'L-BFGS-B', bounds = [(0, None)] * (2 * k),
+                   options = {'maxiter': max_iter, 'gtol': tol, 'ftol': np.finfo(float).eps})
+    if not res.success:
+        warnings.warn(f'WeightedLassoRegression failed to converge: {res.message}', RuntimeWarning)
+    return res.x[:k] - res.x[k:]
 
 class WeightedLassoRegression:
-    def __init__(self, alpha = 0, alpha_weights = None):
+    def __init__(self, alpha = 0, alpha_weights = None, tol = 1e-6, max_iter = 1000, solver = 'cd'):
         """Weighted Lasso Regression
 
         This is a regression algorithm that includes an additional penalizer in its cost function. The penalty
@@ -28,40 +91,61 @@ class WeightedLassoRegression:
             The weights of each predictor variable used in regularization. Larger weights discourage the use of
             the corresponding variable (e.g., when fitting a model with 4 X variables, a weighting of [1, 1, 5, 1]
             would discourage the model from placing much weight on the third variable
+        tol : numeric
+            Fitting stops once no coefficient changes by more than this in a full pass over the predictors
+        max_iter : int
+            The maximum number of passes over the predictors while fitting
+        solver : 'cd' or 'scipy'
+            'cd' fits by coordinate descent. 'scipy' hands the same cost, with its analytic (sub)gradient, to
+            scipy.optimize.minimize; tol and max_iter are passed through to it
         """
         self.alpha = alpha
         self.alpha_weights = alpha_weights
+        self.tol = tol
+        self.max_iter = max_iter
+        self.solver = solver
     
     def fit(self, X, y):
         """Fit
         
-        Fit the model using the predictors specified in X and the criterion specified in y
+        Fit the model using the predictors specified in X and the criterion specified in y. The weights
+        minimize half the sum of squared residuals plus alpha * n * sum(|alpha_weights * weights|). With
+        solver = 'cd' they are found by coordinate descent with a soft-threshold update for each predictor.
+        With solver = 'scipy' the weights are split into positive and negative parts, which makes the cost
+        smooth, and it is minimized under their zero lower bounds by scipy's L-BFGS-B. Either solver raises
+        a RuntimeWarning if it fails to converge within max_iter iterations.
         
         Parameters
         ----------
         X : k x n Array of Data
         y : 1 x n Array of Data
         """
-        from scipy.optimize import minimize
-        xdim = np.shape(X)
-        
-        coefs = [0]
-        coefs.extend(np.zeros(xdim[1]))
+        X = np.asarray(X, dtype = np.float64)
+        y = np.asarray(y, dtype = np.float64)
+        n, k = X.shape
         
         if self.alpha_weights is None:
-            alpha_weights = [1]*xdim[1]
+            alpha_weights = np.ones(k)
         else:
-            alpha_weights = self.alpha_weights
+            alpha_weights = np.asarray(self.alpha_weights, dtype = np.float64)
         
-        def cost(coefs):
-            b = coefs[0]
-            weights = coefs[1:]
-            resid = np.sum(np.abs(y - np.dot(X, weights) - b))
-            penalty = np.sum(np.abs(alpha_weights * weights)) * xdim[0]
-            return resid + self.alpha * penalty
+        x_mean = X.mean(axis = 0)
+        Xc = np.asfortranarray(X - x_mean)
+        resid = y - y.mean()
+        col_norm2 = (Xc**2).sum(axis = 0)
+        thresh = self.alpha * alpha_weights * n
+        if self.solver == 'scipy':
+            weights = _minimize_lasso(Xc, resid, thresh, self.tol, self.max_iter)
+        elif self.solver == 'cd':
+            solve = _cd_lasso if HAS_NUMBA else _cd_lasso_numpy
+            weights, converged = solve(Xc, resid, col_norm2, thresh, float(self.tol), int(self.max_iter))
+            if not converged:
+                warnings.warn(f'WeightedLassoRegression failed to converge in {self.max_iter} iterations',
+                              RuntimeWarning)
+        else:
+            raise ValueError(f"solver must be 'cd' or 'scipy', not {self.solver!r}")
         
-        res = minimize(cost, coefs)
-        self.coefs = res['x']
+        self.coefs = np.concatenate([[y.mean() - x_mean @ weights], weights])
         
     def predict(self, X):
         """Predict
@@ -84,9 +168,12 @@ class WeightedLassoRegression:
         X : k x n Array of Data
         y : 1 x n Array of Data
         """
+        y = np.asarray(y, dtype = np.float64)
         yhat = self.predict(X)
         resid = y-yhat
-        res = {'rmse': np.sqrt(np.mean(resid**2)),
-               'mae': np.mean(np.abs(resid)),
-               'r': np.corrcoef(y, yhat)[0,1]}
+        yc = y - y.mean()
+        yhc = yhat - yhat.mean()
+        res = {'rmse': np.sqrt(resid @ resid/len(resid)),
+               'mae': np.abs(resid).mean(),
+               'r': (yc @ yhc)/np.sqrt((yc @ yc)*(yhc @ yhc))}
         return res
\ No newline at end of file